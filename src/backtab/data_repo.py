@@ -3,7 +3,10 @@ import contextlib
 import datetime
 import decimal
 import os.path
+import secrets
+import socket
 import subprocess
+import sys
 import threading
 import typing
 import beancount.core.account as bcacct
@@ -12,13 +15,29 @@ import beancount.core.inventory as bcinv
 import beancount.core.interpolate as bcinterp
 import beancount.loader
 import beancount.parser.printer
-import beancount.query.query
 import collections
 import io
 
+# This must stay reentrant: pull_changes calls load_data, and apply_txn ends
+# up in pull_changes whenever a push fails, all with the lock already held.
+# Member balances are only mutated under this lock, and load_data replaces
+# the members wholesale, so they need no locking of their own.
 repo_lock = threading.RLock()
 
-CASH_ACCT = "Assets:Cash:Bar"
+# Interned, so postings to these accounts share the string objects that
+# Member.account uses
+CASH_ACCT = sys.intern("Assets:Cash:Bar")
+MEMBERS_ACCT = sys.intern("Liabilities:Bar:Members")
+INVENTORY_ACCT = sys.intern("Assets:Inventory:Bar")
+INCOME_ACCT = sys.intern("Income:Bar")
+
+# Quantization exponents for money and item counts
+_Q2 = decimal.Decimal("0.00")
+_Q0 = decimal.Decimal("0")
+_ROUND = decimal.ROUND_HALF_EVEN
+
+# Our transactions never carry tags or links
+_EMPTY_SET = frozenset()
 
 
 @contextlib.contextmanager
@@ -29,7 +48,39 @@ def transaction():
 
 
 def parse_price(price_str: typing.Union[float, str, decimal.Decimal, int]) -> decimal.Decimal:
-    return decimal.Decimal(price_str).quantize(decimal.Decimal('0.00'), decimal.ROUND_HALF_EVEN)
+    return decimal.Decimal(price_str).quantize(_Q2, _ROUND)
+
+
+def to_cents(amount: decimal.Decimal) -> int:
+    """Convert a price (as returned by parse_price) to an integer number of cents"""
+    return int(amount.scaleb(2))
+
+
+def from_cents(cents: int) -> decimal.Decimal:
+    return decimal.Decimal(cents).scaleb(-2)
+
+
+def file_fingerprint(paths: typing.Iterable[str]) -> typing.Optional[typing.Tuple]:
+    """Identify the current state of a set of files by their mtime and size.
+    Returns None if any of the files has gone missing"""
+    try:
+        return tuple(
+            (path, st.st_mtime_ns, st.st_size)
+            for path, st in ((path, os.stat(path)) for path in paths)
+        )
+    except FileNotFoundError:
+        return None
+
+
+def _quote(text: str) -> str:
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _format_number(number: typing.Union[int, decimal.Decimal]) -> str:
+    # Never use exponent notation; the beancount parser doesn't accept it
+    if isinstance(number, decimal.Decimal):
+        return format(number, "f")
+    return str(number)
 
 
 class UpdateFailed(Exception):
@@ -42,30 +93,39 @@ class Member:
     account: str
     balance: bcinv.Inventory
     item_currencies: typing.Set[str]
+    _balance_eur: typing.Optional[decimal.Decimal]
 
     def __init__(self, account, item_curencies):
         account_parts = account.split(":")
-        if account == "Assets:Cash:Bar":
+        if account == CASH_ACCT:
             self.display_name = "--CASH--"
             self.internal_name = "--cash--"
         elif len(account_parts) != 4:
             raise ValueError("Member account should have four components", account)
         else:
             self.display_name = self.internal_name = account_parts[-1]
-        self.account = account
-        self.balance = decimal.Decimal("0.00")
+        # Interned, as postings are matched against it on every transaction
+        self.account = sys.intern(account)
+        self.balance = bcinv.Inventory()
         self.item_currencies = item_curencies
+        self._balance_eur = None
+
+    def add_amount(self, amount: bcdata.Amount):
+        """Update the balance. Always go through here rather than mutating
+        balance directly, so that the cached EUR balance stays valid"""
+        self.balance.add_amount(amount)
+        self._balance_eur = None
 
     @property
-    def balance_eur(self):
-        return self.balance.get_currency_units("EUR").number.quantize(
-            decimal.Decimal("0.00"), decimal.ROUND_HALF_EVEN)
+    def balance_eur(self) -> decimal.Decimal:
+        if self._balance_eur is None:
+            self._balance_eur = self.balance.get_currency_units("EUR").number.quantize(_Q2, _ROUND)
+        return self._balance_eur
 
     @property
-    def item_count(self):
+    def item_count(self) -> int:
         return sum(
-            int(self.balance.get_currency_units(currency).number.quantize(
-                decimal.Decimal("0"), decimal.ROUND_HALF_EVEN))
+            int(self.balance.get_currency_units(currency).number.quantize(_Q0, _ROUND))
             for currency in self.item_currencies
         )
 
@@ -86,23 +146,29 @@ class Product:
     # inventory tracking. Should be short and all caps
     currency: str
     price: decimal.Decimal
+    _price_cents: int
 
     payback: typing.Optional[Payback]
+    _payback_cents: int
 
-    def __init__(self, definition):
+    def __init__(self, definition: typing.Dict[str, typing.Any]):
         self.name = definition["name"]
         self.localized_name = definition.get("localized_name", {})
-        self.currency = definition["currency"]
+        # Interned, as it ends up in two postings per product bought
+        self.currency = sys.intern(definition["currency"])
         self.price = parse_price(definition["event_price" if SERVER_CONFIG.EVENT_MODE else "price"])
         self.category = definition.get("category", "misc")
         self.sort_key = definition.get("sort_key", "%s_%s" % (self.category, self.name))
+        self._price_cents = to_cents(self.price)
         if "payback" in definition:
             self.payback = Payback(
-                account=definition["payback"]["account"],
+                account=sys.intern(definition["payback"]["account"]),
                 amount=parse_price(definition["payback"]["amount"]),
             )
+            self._payback_cents = to_cents(self.payback.amount)
         else:
             self.payback = None
+            self._payback_cents = 0
 
     def to_json(self) -> typing.Dict:
         """Return the JSON form for clients. This does not include payback
@@ -127,14 +193,19 @@ class Transaction:
                  meta: typing.Optional[typing.Dict[str, str]]=None):
         if meta is None:
             meta = {}
+        now = None
         if date is None:
-            date = datetime.datetime.utcnow()
+            date = now = datetime.datetime.now(datetime.timezone.utc)
         if isinstance(date, datetime.datetime):
+            if now is None:
+                now = datetime.datetime.now(datetime.timezone.utc)
             meta.update(
-                timestamp=str(datetime.datetime.utcnow()),
+                # The format str() gives a naive UTC datetime
+                timestamp=now.strftime("%Y-%m-%d %H:%M:%S.%f"),
             )
             date = date.date()
         self.primary_account = None
+        self._balanced = False
         if title is None:
             raise TypeError("Title must be provided for a transaction")
         self.txn = bcdata.Transaction(
@@ -142,8 +213,8 @@ class Transaction:
             flag="txn",
             payee=None,
             narration=title,
-            tags=set(),
-            links=set(),
+            tags=_EMPTY_SET,
+            links=_EMPTY_SET,
             postings=[],
         )
 
@@ -151,56 +222,95 @@ class Transaction:
     def beancount_txn(self):
         return self.txn
 
+    def render(self) -> str:
+        """Format the transaction as ledger text. Our transactions only have
+        simple postings and no tags or links, which makes this much cheaper
+        than going through beancount's generic printer"""
+        txn = self.txn
+        lines = ["%s %s %s" % (txn.date, txn.flag, _quote(txn.narration))]
+        for key, value in txn.meta.items():
+            lines.append("  %s: %s" % (
+                key, _quote(value) if isinstance(value, str) else value))
+        for posting in txn.postings:
+            lines.append("  %s  %s %s" % (
+                posting.account,
+                _format_number(posting.units.number),
+                posting.units.currency))
+        lines.append("\n")
+        return "\n".join(lines)
+
+    def _check_balanced(self):
+        """Assert that the postings sum to zero in every currency. Our
+        postings never carry a cost or price, so an exact sum suffices"""
+        residual = {}
+        for posting in self.txn.postings:
+            units = posting.units
+            residual[units.currency] = residual.get(units.currency, 0) + units.number
+        assert not any(residual.values()), "Imbalanced transaction generated"
+        self._balanced = True
+
+
+def _aggregate_buy(products: typing.List[typing.Tuple[Product, int]]
+                   ) -> typing.Tuple[int, decimal.Decimal, typing.Dict[str, decimal.Decimal]]:
+    """Sum up a purchase in a single pass over the products. Returns the item
+    count, the total charge, and the amount owed to each payback account.
+    Sums are kept in integer cents and only converted to Decimal at the end"""
+    total_count = 0
+    charge = 0
+    paybacks: typing.Dict[str, int] = {}
+    for product, qty in products:
+        total_count += qty
+        charge += product._price_cents * qty
+        if product.payback is not None:
+            account = product.payback.account
+            paybacks[account] = paybacks.get(account, 0) + product._payback_cents * qty
+    return total_count, from_cents(charge), {
+        account: from_cents(cents)
+        for account, cents in paybacks.items()
+    }
+
 
 class BuyTxn(Transaction):
     def __init__(self,
                  buyer: Member,
                  products: typing.List[typing.Tuple[Product, int]],
                  date: typing.Optional[datetime.datetime]=None):
-        total_cost = decimal.Decimal("0.00")
-        total_count = 0
-        for product, count in products:
-            total_count += count
-            total_cost += count * product.price
+        total_count, charge, paybacks = _aggregate_buy(products)
 
         super(BuyTxn, self).__init__(
             title="%s bought %d items for €%s" % (
-                buyer.display_name, total_count, total_cost,
+                buyer.display_name, total_count, charge,
             ),
             date=date,
             meta={
                 "type": "purchase",
             })
         self.primary_account = buyer
-        charge = decimal.Decimal("0.00")
-        paybacks = collections.defaultdict(lambda: decimal.Decimal("0.00"))
 
+        # Build the postings directly rather than one create_simple_posting
+        # call at a time; they're all plain units without cost or price
+        postings = []
         for product, qty in products:
-            charge += product.price * qty
-            if product.payback is not None:
-                paybacks[product.payback.account] += \
-                    product.payback.amount * qty
-            bcdata.create_simple_posting(
-                self.txn, "Assets:Inventory:Bar",
-                -qty, product.currency)
-            bcdata.create_simple_posting(
-                self.txn, buyer.account,
-                qty, product.currency
-            )
-        bcdata.create_simple_posting(
-            self.txn, buyer.account,
-            charge, "EUR"
-        )
-        for payee, amt in paybacks.items():
-            bcdata.create_simple_posting(
-                self.txn, payee,
-                -amt, "EUR"
-            )
-            charge -= amt
-        bcdata.create_simple_posting(
-            self.txn, "Income:Bar",
-            -charge, "EUR",
-        )
+            # Amount only accepts Decimal numbers
+            count = decimal.Decimal(qty)
+            postings.append(bcdata.Posting(
+                INVENTORY_ACCT, bcdata.Amount(-count, product.currency),
+                None, None, None, None))
+            postings.append(bcdata.Posting(
+                buyer.account, bcdata.Amount(count, product.currency),
+                None, None, None, None))
+        postings.append(bcdata.Posting(
+            buyer.account, bcdata.Amount(charge, "EUR"),
+            None, None, None, None))
+        postings.extend(
+            bcdata.Posting(payee, bcdata.Amount(-amt, "EUR"), None, None, None, None)
+            for payee, amt in paybacks.items())
+        income = charge - sum(paybacks.values())
+        postings.append(bcdata.Posting(
+            INCOME_ACCT, bcdata.Amount(-income, "EUR"),
+            None, None, None, None))
+        self.txn.postings.extend(postings)
+        self._check_balanced()
 
 
 class TransferTxn(Transaction):
@@ -223,6 +333,7 @@ class TransferTxn(Transaction):
             self.txn, payer.account,  amount, "EUR")
         bcdata.create_simple_posting(
             self.txn, payee.account, -amount, "EUR")
+        self._check_balanced()
 
 
 class DepositTxn(Transaction):
@@ -242,6 +353,7 @@ class DepositTxn(Transaction):
             self.txn, member.account, -amount, "EUR")
         bcdata.create_simple_posting(
             self.txn, CASH_ACCT,  amount, "EUR")
+        self._check_balanced()
 
 
 class RepoData:
@@ -256,94 +368,155 @@ class RepoData:
     #    the underlying file may have changed; opened when needed
     instance_ledger_name: typing.Optional[str]
     instance_ledger_uncommitted: bool
+    _instance_ledger_file: typing.Optional[typing.TextIO]
 
     synchronized: bool
+    # Set by git_transaction when pulling to retry a rejected push reloaded
+    # the data, so the live state already includes the new commit
+    commit_reloaded: bool
+    _load_count: int
     _repo_path: str
 
+    # The last successfully parsed ledger, keyed by the fingerprint of every
+    # file it was loaded from (see file_fingerprint)
+    _parse_cache: typing.Dict[str, typing.Any]
+    # (fingerprint, parsed contents) of the last products.yml read
+    _products_cache: typing.Tuple[typing.Optional[typing.Tuple], typing.Any]
+
     def __init__(self, repo_path=None):
         self.instance_ledger_name = None
         self.instance_ledger_uncommitted = True
+        self._instance_ledger_file = None
         self.synchronized = False
         self._repo_path = repo_path or None
+        self._parse_cache = {}
+        self._products_cache = (None, None)
+        self._needs_reload = True
+        self._load_count = 0
+        self.commit_reloaded = False
+        self._hostname = socket.gethostname()
 
     @property
     def repo_path(self):
         return self._repo_path or SERVER_CONFIG.DATA_DIR
 
     @transaction()
-    def pull_changes(self):
-        """Pull the latest changes from the upstream git repo"""
+    def pull_changes(self, force: bool=False):
+        """Pull the latest changes from the upstream git repo. Unless force is
+        set, the live state is only rebuilt if the pull changed its inputs"""
         self.synchronized = False
+        old_head = self.git_head()
         try:
-            subprocess.run("git pull --no-edit "
-                           "|| ( git merge --abort; false; )",
-                           shell=True,
+            subprocess.run(["git", "pull", "--no-edit"],
                            cwd=self.repo_path,
                            stderr=subprocess.PIPE,
                            check=True)
         except subprocess.CalledProcessError as e:
+            # Leave the tree as it was if the merge went wrong
+            # This fails harmlessly if the pull never got to merging
+            subprocess.run(["git", "merge", "--abort"],
+                           cwd=self.repo_path,
+                           stderr=subprocess.DEVNULL)
             raise UpdateFailed(e.stderr)
+        finally:
+            # The pull (or aborted merge) may have rewritten our ledger
+            self.check_instance_ledger()
+
+        if not force and not self._needs_reload and \
+                not self.touches_data(self.changed_files(old_head)):
+            # Nothing that the live state is built from has changed
+            self.synchronized = True
+            return
 
         try:
             self.load_data()
         except Exception as e:
             # Rollback
+            self._needs_reload = True
             self.git_cmd("git", "checkout", "@{-1}")
+            self.check_instance_ledger()
             if isinstance(e, UpdateFailed):
                 raise
             else:
                 raise UpdateFailed("Failed to reload data") from e
         self.synchronized = True
 
+    def git_head(self) -> str:
+        head = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=self.repo_path)
+        return head.decode("utf-8").strip()
+
+    def changed_files(self, since: str) -> typing.List[str]:
+        """List the files that differ between the given commit and HEAD"""
+        changed = subprocess.check_output(["git", "diff", "--name-only", since, "HEAD"],
+                                          cwd=self.repo_path)
+        return changed.decode("utf-8").splitlines()
+
+    def touches_data(self, filenames: typing.Iterable[str]) -> bool:
+        """Whether load_data reads any of the given files (relative to the
+        repo root). Anything counts until the ledger has been loaded once"""
+        if not self._parse_cache:
+            return True
+        data_files = {os.path.realpath(path) for path in self._parse_cache["files"]}
+        data_files.add(os.path.realpath(os.path.join(self.repo_path, "static", "products.yml")))
+        return any(
+            os.path.realpath(os.path.join(self.repo_path, filename)) in data_files
+            for filename in filenames)
+
     def git_cmd(self, *args):
         print("\x1b[1;31mGit command: \x1b[0m" + " ".join(args))
         subprocess.run(list(args),
                        cwd=self.repo_path,
                        check=True)
 
-    def add_file(self, filename: str):
-        self.git_cmd("git", "add", filename)
+    def add_file(self, *filenames: str):
+        self.git_cmd("git", "add", *filenames)
 
     @contextlib.contextmanager
     def git_transaction(self):
-        head = subprocess.check_output(["git", "rev-parse", "HEAD"],
-                                       cwd=self.repo_path)
-        head = head.decode("utf-8").strip()
         try:
             yield
             self.git_cmd("git", "commit", "-m", "Automatic commit by backtab")
         except Exception:
-            self.git_cmd("git", "reset", "--hard", head)
+            # Close the ledger first so that anything still buffered is
+            # flushed before the reset, rather than after it
+            with contextlib.suppress(OSError):
+                self.close_instance_ledger()
+            # Nothing was committed, so HEAD is still the state to return to
+            self.git_cmd("git", "reset", "--hard", "HEAD")
             raise
 
         self.synchronized = False
+        self.commit_reloaded = False
         try:
             self.git_cmd("git", "push")
         except subprocess.SubprocessError:
             # Try pulling first
+            load_count = self._load_count
             self.pull_changes()
+            # If that reloaded the data, the live state already includes the
+            # commit we just made; callers must not apply it a second time
+            self.commit_reloaded = self._load_count != load_count
             self.git_cmd("git", "push")
         self.synchronized = True
 
     @property
     def instance_ledger(self) -> typing.TextIO:
-        while self.instance_ledger_name is None:
-            import datetime
-            import socket
-            trial_name = "%(hostname)s_%(date)s.beancount" % {
-                "hostname": socket.gethostname(),
-                "date": datetime.datetime.now(datetime.timezone.utc),
+        if self.instance_ledger_name is None:
+            base_name = "%(hostname)s_%(date)s" % {
+                "hostname": self._hostname,
+                "date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ"),
             }
-            try:
-                path = os.path.join(self.repo_path, "ledger", trial_name)
-                with open(path, "xt"):
-                    pass
-                print("Got instance ledger " + path)
-                self.instance_ledger_name = path
-            except FileExistsError:
-                import time
-                time.sleep(1)
-                continue
+            trial_name = base_name
+            while self.instance_ledger_name is None:
+                try:
+                    path = os.path.join(self.repo_path, "ledger", trial_name + ".beancount")
+                    with open(path, "xt"):
+                        pass
+                    print("Got instance ledger " + path)
+                    self.instance_ledger_name = path
+                except FileExistsError:
+                    trial_name = "%s_%s" % (base_name, secrets.token_hex(2))
         while self.instance_ledger_uncommitted:
             try:
                 # We have an instance ledger; add it to git and push
@@ -361,53 +534,82 @@ class RepoData:
                     with open(self.instance_ledger_name, "at"):
                         # Make sure the file exists; it might have gotten destroyed by a failed push
                         pass
-                    self.add_file(self.instance_ledger_name)
-                    self.add_file(os.path.join("ledger", "dynamic.beancount"))
+                    self.add_file(self.instance_ledger_name,
+                                  os.path.join("ledger", "dynamic.beancount"))
                 self.instance_ledger_uncommitted = False
                 break
             except subprocess.SubprocessError:
                 self.pull_changes()
                 continue
 
-        return open(self.instance_ledger_name, "at")
+        if self._instance_ledger_file is None:
+            # Append mode, so writes always land at the end of the file
+            # even if git has grown it since we opened it
+            self._instance_ledger_file = open(self.instance_ledger_name, "at")
+        return self._instance_ledger_file
 
     @transaction()
     def apply_txn(self, txn: Transaction) -> typing.List[Member]:
         bc_txn = txn.beancount_txn
 
-        # Ensure that the transaction balances
-        residual = bcinterp.compute_residual(bc_txn.postings)
-        tolerances = bcinterp.infer_tolerances(bc_txn.postings, self.bc_options_map)
-        assert residual.is_small(tolerances), "Imbalanced transaction generated"
+        # Ensure that the transaction balances. Our own transaction types
+        # already checked this when they were built
+        if not getattr(txn, "_balanced", False):
+            residual = bcinterp.compute_residual(bc_txn.postings)
+            tolerances = bcinterp.infer_tolerances(bc_txn.postings, self.bc_options_map)
+            assert residual.is_small(tolerances), "Imbalanced transaction generated"
 
         # add the transaction to the ledger
         while True:
             try:
                 with self.git_transaction():
-                    beancount.parser.printer.print_entry(bc_txn, file=self.instance_ledger)
-                    self.instance_ledger.flush()
+                    # Render up front so the entry goes out in a single write
+                    entry_text = txn.render()
+                    ledger = self.instance_ledger
+                    ledger.write(entry_text)
+                    ledger.flush()
                     self.add_file(self.instance_ledger_name)
             except subprocess.SubprocessError:
                 self.pull_changes()
             else:
                 break
 
-        changed_members = {}
-        # Once it's durable, apply it to the live state
+        # Once it's durable, apply it to the live state (unless pulling to
+        # retry the push already reloaded it from the ledger). Sum up the
+        # postings first so each member's balance is touched once per currency
+        deltas: typing.Dict[Member, typing.Dict[str, decimal.Decimal]] = {}
         for posting in bc_txn.postings:
-            if posting.account in self.accounts_raw:
-                member = self.accounts_raw[posting.account]
-                member.balance.add_amount(posting.units)
-                changed_members[member.internal_name] = member
-        return list(changed_members.values())
+            member = self.accounts_raw.get(posting.account)
+            if member is not None:
+                member_deltas = deltas.setdefault(member, {})
+                currency = posting.units.currency
+                member_deltas[currency] = member_deltas.get(currency, 0) + posting.units.number
+        if not self.commit_reloaded:
+            for member, member_deltas in deltas.items():
+                for currency, number in member_deltas.items():
+                    if number:
+                        member.add_amount(bcdata.Amount(number, currency))
+        if txn.primary_account is not None:
+            # A reload replaces the member objects; report the live one
+            txn.primary_account = self.accounts_raw.get(
+                txn.primary_account.account, txn.primary_account)
+        return list(deltas)
 
     @transaction()
     def load_data(self):
         import yaml
 
         products = {}
-        with open(os.path.join(self.repo_path, "static", "products.yml"), "rt") as f:
-            raw_products = yaml.load(f)
+        products_path = os.path.join(self.repo_path, "static", "products.yml")
+        fingerprint = file_fingerprint([products_path])
+        if fingerprint is not None and fingerprint == self._products_cache[0]:
+            raw_products = self._products_cache[1]
+        else:
+            # Prefer libyaml's loader when PyYAML was built with it
+            loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+            with open(products_path, "rt") as f:
+                raw_products = yaml.load(f, Loader=loader)
+            self._products_cache = (fingerprint, raw_products)
         if type(raw_products) != list:
             raise TypeError("Products should be a list")
         for raw_product in raw_products:
@@ -418,37 +620,24 @@ class RepoData:
 
         product_currencies = {product.currency for product in products.values()}
 
-        # Load ledger
-        ledger_data, errors, options = beancount.loader.load_file(
-            os.path.join(self.repo_path, "bartab.beancount")
-        )
-        if errors:
-            error_stream = io.StringIO("Failed to load ledger\n")
-            beancount.parser.printer.print_errors(errors, error_stream)
-            raise UpdateFailed(error_stream.getvalue())
+        # Load ledger, unless none of the files it was built from have changed
+        ledger_data, options, balances = self.load_ledger()
 
         accounts = {}
         accounts_raw = {}
-        # TODO: Handle this using a realization
-        balances = {
-            row.account: row.balance
-            for row in beancount.query.query.run_query(ledger_data, options, """
-                select account, sum(position) as balance
-                where PARENT(account) = "Liabilities:Bar:Members"
-                   OR account = "Assets:Cash:Bar" 
-                group by account
-                """)[1]
-        }
         for entry in ledger_data:
             if not isinstance(entry, bcdata.Open):
                 continue
-            if not bcacct.parent(entry.account) == "Liabilities:Bar:Members" and entry.account != "Assets:Cash:Bar":
+            if not bcacct.parent(entry.account) == MEMBERS_ACCT and entry.account != CASH_ACCT:
                 print("Didn't load %s as it's no bar account" % (entry.account,))
                 continue
             acct = Member(entry.account, item_curencies=product_currencies)
             if "display_name" in entry.meta:
                 acct.display_name = entry.meta["display_name"]
-            acct.balance = balances.get(acct.account, bcinv.Inventory())
+            # Copy the cached balance; the member's copy gets updated in place
+            acct.balance = bcinv.Inventory(
+                balances[acct.account].get_positions()
+                if acct.account in balances else None)
             accounts[acct.internal_name] = acct
             accounts_raw[acct.account] = acct
 
@@ -457,11 +646,65 @@ class RepoData:
         self.accounts = accounts
         self.products = products
         self.bc_options_map = options
+        self._needs_reload = False
+        self._load_count += 1
+
+    def load_ledger(self):
+        """Parse the ledger and compute the bar account balances. The result
+        is cached until one of the ledger's source files changes"""
+        cache = self._parse_cache
+        if cache and file_fingerprint(cache["files"]) == cache["fingerprint"]:
+            return cache["ledger_data"], cache["options"], cache["balances"]
+
+        ledger_data, errors, options = beancount.loader.load_file(
+            os.path.join(self.repo_path, "bartab.beancount")
+        )
+        if errors:
+            error_stream = io.StringIO("Failed to load ledger\n")
+            beancount.parser.printer.print_errors(errors, error_stream)
+            raise UpdateFailed(error_stream.getvalue())
+
+        # Sum the postings to the bar accounts directly; this is all the
+        # query engine would do, minus parsing and planning the query
+        balances = collections.defaultdict(bcinv.Inventory)
+        for entry in ledger_data:
+            if not isinstance(entry, bcdata.Transaction):
+                continue
+            for posting in entry.postings:
+                account = posting.account
+                if account == CASH_ACCT or bcacct.parent(account) == MEMBERS_ACCT:
+                    balances[account].add_position(posting)
+
+        # The loader records every file it read, including nested includes
+        files = options["include"]
+        cache.clear()
+        cache.update(
+            files=files,
+            fingerprint=file_fingerprint(files),
+            ledger_data=ledger_data,
+            options=options,
+            balances=balances,
+        )
+        return ledger_data, options, balances
 
     def close_instance_ledger(self):
-        if self.instance_ledger is not None:
-            self.instance_ledger.close()
-            self.instance_ledger = None
+        ledger, self._instance_ledger_file = self._instance_ledger_file, None
+        if ledger is not None:
+            ledger.close()
+
+    def check_instance_ledger(self):
+        """Close the instance ledger if git has replaced the file since it was
+        opened (e.g., by a checkout or reset); it gets reopened on next use"""
+        if self._instance_ledger_file is None:
+            return
+        try:
+            current = os.stat(self.instance_ledger_name)
+        except FileNotFoundError:
+            self.close_instance_ledger()
+            return
+        opened = os.fstat(self._instance_ledger_file.fileno())
+        if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            self.close_instance_ledger()
 
 
 REPO_DATA = RepoData()
@@ -44,7 +44,7 @@ def accounts():
 def update():
     time.sleep(SERVER_CONFIG.SLOWDOWN)
     try:
-        REPO_DATA.pull_changes()
+        REPO_DATA.pull_changes(force=True)
         return "Success"
     except UpdateFailed as e:
         raise bottle.HTTPResponse(body=traceback.format_exc())
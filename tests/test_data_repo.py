@@ -0,0 +1,109 @@
+import decimal
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("beancount")
+
+from backtab import data_repo  # noqa: E402
+
+LEDGER = """\
+option "operating_currency" "EUR"
+
+2020-01-01 open Assets:Cash:Bar
+2020-01-01 open Assets:Inventory:Bar
+2020-01-01 open Income:Bar
+2020-01-01 open Liabilities:Bar:Members:Alice
+
+include "ledger/dynamic.beancount"
+"""
+
+PRODUCTS = """\
+- name: Club Mate
+  currency: MATE
+  price: 1.50
+"""
+
+
+def git(cwd, *args):
+    subprocess.run(["git"] + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    for var in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv("GIT_%s_NAME" % var, "backtab")
+        monkeypatch.setenv("GIT_%s_EMAIL" % var, "backtab@example.com")
+
+    seed = tmp_path / "seed"
+    (seed / "ledger").mkdir(parents=True)
+    (seed / "static").mkdir()
+    (seed / "bartab.beancount").write_text(LEDGER)
+    (seed / "ledger" / "dynamic.beancount").write_text("")
+    (seed / "static" / "products.yml").write_text(PRODUCTS)
+    git(seed, "init", "-q")
+    git(seed, "add", ".")
+    git(seed, "commit", "-q", "-m", "Initial data")
+    git(tmp_path, "clone", "-q", "--bare", str(seed), "remote.git")
+    return tmp_path / "remote.git"
+
+
+def make_repo(remote, name):
+    """Clone the remote and load it as a separate backtab instance"""
+    work = str(remote.parent / name)
+    git(remote.parent, "clone", "-q", str(remote), name)
+    git(work, "config", "pull.rebase", "false")
+
+    repo = data_repo.RepoData(repo_path=work)
+    # Instances sharing a remote need distinct instance ledgers
+    repo._hostname = name
+    repo.pull_changes()
+    return repo
+
+
+@pytest.fixture
+def repo(remote):
+    return make_repo(remote, "work")
+
+
+def test_buy_updates_live_state_and_ledger(repo):
+    alice = repo.accounts["Alice"]
+    txn = data_repo.BuyTxn(alice, [(repo.products["MATE"], 2)])
+
+    changed = repo.apply_txn(txn)
+
+    assert changed == [alice]
+    assert alice.balance_eur == decimal.Decimal("3.00")
+    assert alice.item_count == 2
+
+    # The committed ledger must load back to the same state
+    reloaded = data_repo.RepoData(repo_path=repo.repo_path)
+    reloaded.load_data()
+    assert reloaded.accounts["Alice"].balance_eur == decimal.Decimal("3.00")
+    assert reloaded.accounts["Alice"].item_count == 2
+
+
+def test_deposit_balances_cash(repo):
+    alice = repo.accounts["Alice"]
+    repo.apply_txn(data_repo.DepositTxn(alice, decimal.Decimal("2.00")))
+
+    assert alice.balance_eur == decimal.Decimal("-2.00")
+    assert repo.accounts["--cash--"].balance_eur == decimal.Decimal("2.00")
+
+
+def test_rejected_push_applies_txn_once(remote):
+    second = make_repo(remote, "second")
+    second.apply_txn(data_repo.DepositTxn(second.accounts["Alice"], decimal.Decimal("1.00")))
+    first = make_repo(remote, "first")
+    first.apply_txn(data_repo.DepositTxn(first.accounts["Alice"], decimal.Decimal("2.00")))
+
+    # second is now behind, so its push gets rejected and it has to pull
+    txn = data_repo.DepositTxn(second.accounts["Alice"], decimal.Decimal("4.00"))
+    changed = second.apply_txn(txn)
+
+    assert second.accounts["Alice"].balance_eur == decimal.Decimal("-7.00")
+    assert [member.balance_eur for member in changed] == [
+        decimal.Decimal("-7.00"), decimal.Decimal("7.00")]
+    assert txn.primary_account.balance_eur == decimal.Decimal("-7.00")